@@ -1,22 +1,36 @@
 import argparse
-import configparser
+import concurrent.futures
+import contextlib
+import copy
 import ctypes
-import io
+import functools
+import heapq
+import itertools
 import logging
+import math
+import msvcrt
+import operator
 import os
+import queue
 import re
+import shlex
 import socket
 import subprocess
 import sys
 import threading
 import time
+import types
+import weakref
 import xmlrpc.client
 import xmlrpc.server
 
+import ntsecuritycon
 import psutil
 import servicemanager
 import win32api
 import win32con
+import win32event
+import win32file
 import win32job
 import win32service
 import win32serviceutil
@@ -31,6 +45,40 @@ logging.basicConfig(
 # Command parameter to start the service itself.
 SERVICE_COMMAND_CONSTANT = "service"
 
+# Address of the XML-RPC server of the service.
+XMLRPC_HOST = "127.0.0.1"
+XMLRPC_PORT = 9001
+XMLRPC_URL = f"http://{XMLRPC_HOST}:{XMLRPC_PORT}"
+
+# States of a program as reported by the status command.
+STATE_STOPPED = "STOPPED"
+STATE_STARTING = "STARTING"
+STATE_RUNNING = "RUNNING"
+STATE_BACKOFF = "BACKOFF"
+
+# Line patterns of the INI-style configuration file and of `%(VAR)s` references in its values.
+# Same header pattern as configparser: anything after the closing bracket is ignored
+_SECTION_RE = re.compile(r"\[(?P<header>.+)\]")
+_KV_RE = re.compile(r"^([^=:\s][^=:]*)\s*[=:]\s*(.*)$")
+_ENV_RE = re.compile(r"%\((\w+)\)s")
+
+# Parsed config files keyed by absolute path, each stored with the (mtime, size) it was parsed at, so an unchanged file
+# is never parsed twice and an edited one replaces its old entry.
+_CONFIG_CACHE: dict[str, tuple[tuple, dict]] = {}
+
+# Log directories already created by this process.
+_MKDIR_CACHE: set[str] = set()
+
+# Options of the service itself, dropped from the argv handed to HandleCommandLine.
+_SERVICE_OPTIONS = frozenset(("--config", "--env"))
+
+# Strings accepted as true and false for boolean options (same as configparser's getboolean).
+TRUE_VALUES = ("1", "yes", "true", "on")
+FALSE_VALUES = ("0", "no", "false", "off")
+
+# Section whose options apply to every other section, as with configparser.
+DEFAULT_SECTION = "DEFAULT"
+
 
 def kill_process_tree(pid):
     """Recursively kill a process and all its children."""
@@ -51,97 +99,385 @@ def kill_process_tree(pid):
         pass
 
 
+def _env_lookup(match, _getenv=os.environ.get):
+    """Substitution callback for _ENV_RE: the referenced environment variable, or "" if unset."""
+    return _getenv(match[1], "")
+
+
+def program_sections(config):
+    """Return the `program:NAME` sections of a loaded config as a `{NAME: options}` dict."""
+    prefix_len = len("program:")
+    return {section[prefix_len:]: options for section, options in config.items() if section.startswith("program:")}
+
+
+def config_bool(config, key):
+    """Read a boolean option from a program section, defaulting to False.
+
+    Raises ValueError for anything else than the values configparser's getboolean accepts.
+    """
+    value = config.get(key, "false").lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError(f"Not a boolean: {value}")
+
+
+def ensure_dir(directory):
+    """Create a directory (and its parents) unless this process already did so."""
+    if directory not in _MKDIR_CACHE:
+        os.makedirs(directory, exist_ok=True)
+        _MKDIR_CACHE.add(directory)
+
+
+def open_log_file(path):
+    """Open a log file for appending, to be handed to a child process.
+
+    The child writes to the OS handle directly, bypassing the C runtime's append emulation, so the handle is created
+    with FILE_APPEND_DATA access only: every write then lands at the end of the file, even with several processes
+    logging to it.
+    """
+    try:
+        handle = win32file.CreateFile(
+            path,
+            ntsecuritycon.FILE_APPEND_DATA,
+            win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE | win32file.FILE_SHARE_DELETE,
+            None,
+            win32file.OPEN_ALWAYS,
+            win32file.FILE_ATTRIBUTE_NORMAL,
+            None,
+        )
+    except win32file.error as e:
+        raise OSError(None, e.strerror, path, e.winerror) from e  # Maps the Win32 error to errno and the OSError subclass
+    fd = msvcrt.open_osfhandle(handle.Detach(), os.O_WRONLY | os.O_APPEND)
+    return open(fd, "ab", buffering=0)
+
+
+def split_command(command):
+    """Split a command line into arguments, keeping quoted arguments (including Windows paths) together.
+
+    Quotes around an argument are removed; Popen adds them back where needed when building the command line.
+    """
+    return [arg[1:-1] if len(arg) > 1 and arg[0] == arg[-1] and arg[0] in "\"'" else arg for arg in shlex.split(command, posix=False)]
+
+
+class StartupTimer:
+    """Runs delayed callbacks, such as start-up checks, on one shared background thread."""
+
+    def __init__(self):
+        self._heap = []  # (deadline, sequence number, callback)
+        self._sequence = itertools.count()  # Tie-breaker, callbacks are not comparable
+        self._cv = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay, callback):
+        """Call `callback` from the timer thread after `delay` seconds."""
+        with self._cv:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._sequence), callback))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cv.notify()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._heap:
+                    self._cv.wait()
+                remaining = self._heap[0][0] - time.monotonic()
+                if remaining > 0:
+                    self._cv.wait(remaining)
+                    continue
+                _, _, callback = heapq.heappop(self._heap)
+            try:
+                callback()
+            except Exception:
+                logging.exception("Startup timer callback failed")  # Keep the shared thread alive
+
+
+# Shared by all programs, so restarts do not spawn a thread each.
+_startup_timer = StartupTimer()
+
+
+class HandleGroupWaiter:
+    """Waits on a group of process handles on a long-lived thread and sets `wakeup_event` when one of them is signalled.
+
+    Lets the monitor watch more handles than one WaitForMultipleObjects call takes. The monitor hands over a changed
+    group with set_handles(), which returns once the thread no longer waits on the previous handles, so those can be
+    closed.
+    """
+
+    def __init__(self, wakeup_event, handles):
+        self.handles = handles
+        self.signalled = False  # One of `handles` was signalled, the thread waits for set_handles() before waiting again
+        self._wakeup_event = wakeup_event
+        self._refresh_event = win32event.CreateEvent(None, False, False, None)  # noqa: FBT003 Boolean positional value in function call
+        self._refreshed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def set_handles(self, handles):
+        """Waits on `handles` from now on, or lets the thread exit for None."""
+        self._refreshed.clear()
+        self.handles = handles
+        self.signalled = False
+        win32event.SetEvent(self._refresh_event)
+        self._refreshed.wait()
+
+    def _run(self):
+        handles = self.handles
+        while handles is not None:
+            if win32event.WaitForMultipleObjects([self._refresh_event, *handles], False, win32event.INFINITE) != win32event.WAIT_OBJECT_0:  # noqa: FBT003 Boolean positional value in function call
+                self.signalled = True
+                win32event.SetEvent(self._wakeup_event)
+                # A process handle stays signalled, wait for the monitor to take it out instead of spinning on it
+                win32event.WaitForSingleObject(self._refresh_event, win32event.INFINITE)
+            handles = self.handles
+            self._refreshed.set()
+        self._refresh_event.Close()
+
+
 class Program:
     """Represents a managed program."""
 
     def __init__(self, name, config, job_handle=None):
         self.name = name
         self.command = config["command"]
-        self.autostart = config.getboolean("autostart", False)
-        self.autorestart = config.getboolean("autorestart", False)
+        self.autostart = config_bool(config, "autostart")
+        self.autorestart = config_bool(config, "autorestart")
         self.stdout_logfile = config.get("stdout_logfile", None)
         self.stderr_logfile = config.get("stderr_logfile", None)
-        self.redirect_stderr = config.getboolean("redirect_stderr", False)
+        self.redirect_stderr = config_bool(config, "redirect_stderr")
         self.directory = config.get("directory", None)
+        self._cmd_argv = split_command(self.command)
+        self._stdout_dir = os.path.dirname(self.stdout_logfile) if self.stdout_logfile else None
+        self._stderr_dir = os.path.dirname(self.stderr_logfile) if self.stderr_logfile and not self.redirect_stderr else None
+        # Start children without a console window of their own and outside the supervisor's console group
+        self._startupinfo = subprocess.STARTUPINFO()
+        self._startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        self._startupinfo.wShowWindow = subprocess.SW_HIDE
+        self._creationflags = subprocess.CREATE_NO_WINDOW | subprocess.CREATE_NEW_PROCESS_GROUP
         self.process = None
-        self.start_time = None
+        self._exit_cached = None  # Exit code of `process` once it has been observed
+        self.start_time = None  # time.monotonic_ns() of the last start, immune to wall clock adjustments
         self.restart_count = 0
         self.backoff_index = 0
         self.backoff_periods = [0, 1, 2, 5, 10, 15]  # Backoff periods in seconds
+        self.max_backoff_index = len(self.backoff_periods) - 1
+        self.backoff_reset_uptime = 10  # Seconds a run must last for the next restart to start the backoff over
+        self.next_restart_time = None  # time.monotonic() at which the monitor restarts the program
         self.stdout_file = None
         self.stderr_file = None
-        self.is_starting = False
+        self._files_stack = contextlib.ExitStack()  # Owns the log files of the current process
+        # Safety net for a Program dropped without stop_program(), closing an empty stack is a no-op
+        weakref.finalize(self, self._files_stack.close)
+        self.state = STATE_STOPPED  # Kept up to date by the lifecycle methods and the monitor, so status() needs no syscalls
+        # Serializes starts, stops and exit handling, which run on XML-RPC workers, the thread pool and the monitor.
+        # Reentrant, so restart_program can hold it across its stop and start.
+        self.lock = threading.RLock()
 
         self.job_handle = job_handle
 
+    @property
+    def is_starting(self):
+        return self.state == STATE_STARTING
+
+    def poll(self):
+        """Return the exit code of the process, or None if it is still running or there is no process.
+
+        The exit code of a process never changes, so it is remembered once seen.
+        """
+        if self.process is None:
+            return None
+        if self._exit_cached is None:
+            self._exit_cached = self.process.poll()
+        return self._exit_cached
+
     def start_program(self):
-        if self.process is not None and self.process.poll() is None:
-            return  # Already running
-        self.is_starting = True
+        with self.lock:
+            self.next_restart_time = None
+            if self.process is not None and self.poll() is None:
+                return  # Already running
+            self.state = STATE_STARTING
+            try:
+                self.close_files()  # Log files of a previous, exited process
+                if self.stdout_logfile:
+                    # The child writes to the OS handle directly, a Python-side buffer or text wrapper would never see its output
+                    self.stdout_file = self._files_stack.enter_context(self._open_log(self.stdout_logfile, self._stdout_dir))
+                else:
+                    self.stdout_file = None
+                if self.redirect_stderr:
+                    stderr = subprocess.STDOUT
+                    self.stderr_file = None
+                elif self.stderr_logfile:
+                    self.stderr_file = self._files_stack.enter_context(self._open_log(self.stderr_logfile, self._stderr_dir))
+                    stderr = self.stderr_file
+                else:
+                    self.stderr_file = None
+                    stderr = None
+
+                cmd_args = self._cmd_argv
+                self._exit_cached = None
+                self.process = subprocess.Popen(  # noqa: S603 `subprocess` call: check for execution of untrusted input. user has to make sure that cmd_args is safe.
+                    cmd_args,
+                    stdout=self.stdout_file,
+                    stderr=stderr,
+                    start_new_session=False,
+                    cwd=self.directory,
+                    startupinfo=self._startupinfo,
+                    creationflags=self._creationflags,
+                )
+                self._add_process_to_job()
+
+                self.start_time = time.monotonic_ns()
+                # Give it a moment to start. Bound to this process, so a check outlived by a restart does nothing.
+                _startup_timer.schedule(1, functools.partial(self._check_start_success, self.process))
+            except (OSError, ValueError) as e:
+                servicemanager.LogErrorMsg(f"Failed to start {self.name}: {e!s}")
+                self.close_files()
+                self.state = STATE_STOPPED
+
+    @staticmethod
+    def _open_log(path, directory):
+        """Opens a log file with open_log_file(), creating its directory first.
+
+        ensure_dir() creates a directory only once per process. Should it have been removed since, it is created
+        again and the file opened once more.
+        """
+        if directory:
+            ensure_dir(directory)
         try:
-            if self.stdout_logfile:
-                os.makedirs(os.path.dirname(self.stdout_logfile), exist_ok=True)
-                raw_stdout_file = open(self.stdout_logfile, "ab", buffering=0)  # noqa: SIM115 Use a context manager for opening files. File handle is needed during the subprocess' lifetime.
-                self.stdout_file = io.TextIOWrapper(raw_stdout_file, encoding="utf-8", line_buffering=True)  # Line buffered text wrapper
-            else:
-                self.stdout_file = None
-            if self.redirect_stderr:
-                stderr = subprocess.STDOUT
-                self.stderr_file = None
-            elif self.stderr_logfile:
-                os.makedirs(os.path.dirname(self.stderr_logfile), exist_ok=True)
-                raw_stderr_file = open(self.stderr_logfile, "ab", buffering=0)  # noqa: SIM115 Use a context manager for opening files. File handle is needed during the subprocess' lifetime.
-                self.stderr_file = io.TextIOWrapper(raw_stderr_file, encoding="utf-8", line_buffering=True)
-                stderr = self.stderr_file
+            return open_log_file(path)
+        except FileNotFoundError:
+            if not directory:
+                raise
+            _MKDIR_CACHE.discard(directory)
+            ensure_dir(directory)
+            return open_log_file(path)
+
+    def _check_start_success(self, process):
+        """Check if `process`, started a moment ago, is still running.
+
+        The backoff is left alone: a program that crashes a few seconds after starting must keep backing off, so only
+        the monitor resets it, once a run has lasted `backoff_reset_uptime`.
+        """
+        if self.process is not process:
+            return  # Stopped or restarted meanwhile, a later check covers the new process. Skips waiting for the lock.
+        with self.lock:
+            if self.process is not process:
+                return
+            if self.poll() is None:
+                self.state = STATE_RUNNING
             else:
-                self.stderr_file = None
-                stderr = None
-
-            cmd_args = self.command.split()
-            self.process = subprocess.Popen(cmd_args, stdout=self.stdout_file, stderr=stderr, start_new_session=False, cwd=self.directory)  # noqa: S603 `subprocess` call: check for execution of untrusted input. user has to make sure that cmd_args is safe.
-            self._add_process_to_job()
-
-            self.start_time = time.time()
-            # Reset backoff if process successfully starts
-            threading.Thread(target=self._check_start_success, daemon=True).start()
-        except (OSError, ValueError) as e:
-            servicemanager.LogErrorMsg(f"Failed to start {self.name}: {e!s}")
-            self.is_starting = False
-
-    def _check_start_success(self):
-        """Check if the process starts successfully and reset backoff."""
-        time.sleep(1)  # Give it a moment to start
-        if self.process and self.process.poll() is None:
-            self.backoff_index = 0  # Reset backoff on successful start
-        self.is_starting = False
+                self.state = STATE_STOPPED  # The monitor moves it to BACKOFF if it is restarted
 
     def _add_process_to_job(self):
-        # Convert process ID to handle with required permissions
-        perms = win32con.PROCESS_TERMINATE | win32con.PROCESS_SET_QUOTA
-        process_handle = win32api.OpenProcess(perms, False, self.process.pid)  # noqa: FBT003 Boolean positional value in function call
-
-        # Assign the child process to the Job Object
-        win32job.AssignProcessToJobObject(self.job_handle, process_handle)
+        # The child already inherits the supervisor's job at creation, assigning it explicitly keeps it there
+        # should the supervisor ever run outside the job. Popen holds a full-access process handle, use that one
+        # instead of opening another.
+        win32job.AssignProcessToJobObject(self.job_handle, self.process._handle)  # noqa: SLF001 Private member accessed
 
     def stop_program(self):
-        if self.process is not None and self.process.poll() is None:
-            kill_process_tree(self.process.pid)
-        self.close_files()
-        self.process = None
-        self.is_starting = False
+        with self.lock:
+            if self.process is not None and self.poll() is None:
+                kill_process_tree(self.process.pid)
+            self.close_files()
+            self.process = None
+            self.next_restart_time = None
+            self.state = STATE_STOPPED
+
+    def restart_program(self):
+        with self.lock:
+            self.stop_program()
+            self.start_program()
 
     def close_files(self):
         """Closes log file handles if they are open."""
-        if self.stdout_file:
-            self.stdout_file.close()
-            self.stdout_file = None
-        if self.stderr_file:
-            self.stderr_file.close()
-            self.stderr_file = None
+        self._files_stack.close()
+        self.stdout_file = None
+        self.stderr_file = None
+
+
+class QuietXMLRPCRequestHandler(xmlrpc.server.SimpleXMLRPCRequestHandler):
+    """XML-RPC request handler that does not log requests or look up client host names.
+
+    Speaks HTTP/1.1, so a client can send several calls over one connection. While every worker of the server has a
+    connection, responses end with `Connection: close`, so idle keep-alive clients reconnect and free their worker.
+    Idle connections are dropped after `timeout` seconds.
+    """
+
+    protocol_version = "HTTP/1.1"
+    timeout = 10
 
-    def __del__(self):
-        """Destructor to ensure resources are freed when the object is deleted."""
-        self.close_files()
+    def address_string(self):
+        return ""
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+    def end_headers(self):
+        if not self.close_connection and self.server.is_saturated():
+            self.send_header("Connection", "close")  # Also makes the handler drop the connection after this response
+        super().end_headers()
+
+
+class ThreadingXMLRPCServer(xmlrpc.server.SimpleXMLRPCServer):
+    """XML-RPC server handling connections on a fixed set of daemon worker threads, so concurrent clients are not serialized.
+
+    The workers are daemon threads and server_close() shuts down every open connection, so connected clients
+    neither keep the process alive nor reach the service once it is stopped.
+    """
+
+    allow_reuse_address = True
+    max_workers = 8
+
+    def __init__(self, *args, **kwargs):
+        self._queue = queue.SimpleQueue()  # Accepted connections waiting for a worker, None tells a worker to exit
+        self._open_requests = set()  # Accepted connections, queued or being served
+        self._lock = threading.Lock()
+        self._closing = False
+        super().__init__(*args, **kwargs)
+        for _ in range(self.max_workers):
+            threading.Thread(target=self._worker, name="xmlrpc", daemon=True).start()
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self._open_requests.add(request)
+        self._queue.put((request, client_address))
+
+    def is_saturated(self):
+        """Whether there are as many open connections as workers, any further client would have to wait."""
+        return len(self._open_requests) >= self.max_workers
+
+    def _worker(self):
+        """Same as socketserver.ThreadingMixIn.process_request_thread, for each connection taken from the queue."""
+        while (item := self._queue.get()) is not None:
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:  # noqa: BLE001 Do not catch blind exception. Reported by handle_error like socketserver does.
+                if not self._closing:  # Errors of connections shut down by server_close() are expected
+                    self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def shutdown_request(self, request):
+        with self._lock:
+            self._open_requests.discard(request)
+        super().shutdown_request(request)
+
+    def server_close(self):
+        """Closes the listening socket and every open connection, and lets the workers exit."""
+        super().server_close()
+        with self._lock:
+            self._closing = True
+            open_requests = list(self._open_requests)
+        for request in open_requests:
+            # Queued connections are then closed by a worker without running a call, busy ones fail their next read or write
+            with contextlib.suppress(OSError):
+                request.shutdown(socket.SHUT_RDWR)
+        for _ in range(self.max_workers):
+            self._queue.put(None)
 
 
 class MyServiceFramework(win32serviceutil.ServiceFramework):
@@ -150,6 +486,22 @@ class MyServiceFramework(win32serviceutil.ServiceFramework):
     _exe_name_ = sys.executable
     _exe_args_ = '-u -E "' + os.path.abspath(__file__) + '"'
 
+    def __init__(self, *args):
+        super().__init__(*args)
+        # Set by SvcStop to unblock the monitor loop.
+        self._stop_event = win32event.CreateEvent(None, True, False, None)  # noqa: FBT003 Boolean positional value in function call
+        # Set when programs are started outside the monitor loop, so it starts watching their processes.
+        self._wakeup_event = win32event.CreateEvent(None, False, False, None)  # noqa: FBT003 Boolean positional value in function call
+        # What the monitor loop waits on: both events, then one handle per watched process. The watched
+        # pids and programs are kept in lists parallel to the process handles.
+        self._wait_objects = [self._stop_event, self._wakeup_event]
+        self._watched_pids = []
+        self._watched_programs = []
+        # One waiter per group of process handles beyond the first MAXIMUM_WAIT_OBJECTS wait objects.
+        self._overflow_waiters = []
+        # Starts and stops programs in parallel, Popen and stop_program can each take a while.
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix="program")
+
     def SvcDoRun(self):  # noqa: N802 (Function name should be lowercase): overriding interface method.
         self.ReportServiceStatus(win32service.SERVICE_START_PENDING)
 
@@ -161,13 +513,13 @@ class MyServiceFramework(win32serviceutil.ServiceFramework):
             for key, value in args.env:
                 os.environ[f"ENV_{key}"] = value
 
-        # Load and process config
-        config = self.load_config(self.config_path)
+        # Load and process config, kept for reread() to compare against
+        self.config = self.load_config(self.config_path)
 
         self.job_handle = self.create_job()
 
         # Load programs from config
-        self.programs = self.load_programs(config)
+        self.programs = self.load_programs(self.config)
 
         # Start XML-RPC server
         self.start_xmlrpc_server()
@@ -183,35 +535,103 @@ class MyServiceFramework(win32serviceutil.ServiceFramework):
         self.monitor_programs()
 
     def parse_arguments(self):
-        parser = argparse.ArgumentParser()
-        parser.add_argument("--config", required=True)
-        parser.add_argument(
-            "--env",
-            action="append",
-            type=lambda kv: tuple(kv.split("=", 1)),
-            help="Environment variable as NAME=VALUE (can be repeated)",
-        )
-        argv = sys.argv[2:]
+        """Parses the service command line: `--config PATH` and any number of `--env NAME=VALUE`.
+
+        The arguments are the ones written by `--service install`, a plain scan is enough and avoids building an ArgumentParser.
+        """
+        argv = sys.argv[2:]  # Skip script and "service"
         if argv and argv[0] == "debug":  # Check for empty argv to avoid IndexError
             argv = argv[1:]
-        return parser.parse_args(argv)  # Skip script and "service"
+        args = types.SimpleNamespace(config=None, env=None)
+        remaining = iter(argv)
+        for arg in remaining:
+            option, has_value, value = arg.partition("=")
+            if option not in ("--config", "--env"):
+                servicemanager.LogErrorMsg(f"Unrecognized argument: {arg}")
+                raise ValueError(f"Unrecognized argument: {arg}")
+            if not has_value:
+                value = next(remaining, None)
+                if value is None:
+                    servicemanager.LogErrorMsg(f"Argument {option}: expected one argument")
+                    raise ValueError(f"Argument {option}: expected one argument")
+            if option == "--config":
+                args.config = value
+                continue
+            name, has_equals, env_value = value.partition("=")
+            if not name or not has_equals:
+                servicemanager.LogErrorMsg(f"Argument --env: expected NAME=VALUE, got {value!r}")
+                raise ValueError(f"Argument --env: expected NAME=VALUE, got {value!r}")
+            if args.env is None:
+                args.env = []
+            args.env.append((name, env_value))
+        if args.config is None:
+            servicemanager.LogErrorMsg("The --config argument is required")
+            raise ValueError("The --config argument is required")
+        return args
 
     def load_config(self, config_path):
-        """Loads and processes the configuration file."""
-        config = configparser.RawConfigParser()
-        if not os.path.exists(config_path):
-            servicemanager.LogErrorMsg(f"Config file not found: {config_path}")
-            raise FileNotFoundError(f"Config file not found: {config_path}")
-
-        config.read(config_path)
+        """Loads the configuration file into a `{section: {key: value}}` dict.
 
-        # Replace environment variables in config
-        for section in config.sections():
-            for key in config[section]:
-                value = config[section][key]
-                config[section][key] = re.sub(r"%\((\w+)\)s", lambda m: os.environ.get(m.group(1), ""), value)
-
-        return config
+        Follows configparser's rules: options of the DEFAULT section apply to every section, and duplicate sections or
+        options are rejected. Environment variables referenced as `%(VAR)s` are substituted while the file is scanned.
+        The result is cached until the file's mtime or size changes; callers get their own copy.
+        """
+        try:
+            st = os.stat(config_path)  # Also the existence check
+        except FileNotFoundError:
+            servicemanager.LogErrorMsg(f"Config file not found: {config_path}")
+            raise FileNotFoundError(f"Config file not found: {config_path}") from None
+        cache_key = os.path.abspath(config_path)
+        signature = (st.st_mtime_ns, st.st_size)
+        cached = _CONFIG_CACHE.get(cache_key)
+        if cached is not None and cached[0] == signature:
+            return copy.deepcopy(cached[1])
+
+        with open(config_path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+
+        config = {}
+        section = None
+        key = None
+        blank_lines = 0  # Blank lines seen inside the current value, kept only if a continuation line follows
+        for lineno, line in enumerate(lines, 1):
+            stripped = line.strip()
+            if not stripped:
+                if key is not None:
+                    blank_lines += 1
+                continue
+            if stripped[0] in "#;":
+                continue
+            if line[0].isspace() and key is not None:
+                # Indented line: continuation of the previous value
+                section[key] += "\n" * (blank_lines + 1) + (_ENV_RE.sub(_env_lookup, stripped) if "%(" in stripped else stripped)
+                blank_lines = 0
+                continue
+            blank_lines = 0
+            match = _SECTION_RE.match(stripped)
+            if match:
+                name = match.group("header")
+                if name in config:
+                    raise ValueError(f"Duplicate section {name!r} on line {lineno} in config file {config_path}")
+                section = config[name] = {}
+                key = None
+                continue
+            match = _KV_RE.match(stripped)
+            if match is None or section is None:
+                raise ValueError(f"Invalid line {lineno} in config file {config_path}: {line!r}")
+            key = match.group(1).rstrip().lower()
+            if key in section:
+                raise ValueError(f"Duplicate option {key!r} on line {lineno} in config file {config_path}")
+            value = match.group(2)
+            # Most values reference no variable, a substring check is far cheaper than a regex scan
+            section[key] = _ENV_RE.sub(_env_lookup, value) if "%(" in value else value
+
+        defaults = config.pop(DEFAULT_SECTION, None)
+        if defaults:
+            config = {name: {**defaults, **options} for name, options in config.items()}
+
+        _CONFIG_CACHE[cache_key] = (signature, config)
+        return copy.deepcopy(config)
 
     def create_job(self):
         """Needed to ensure that all processes exit when the service is terminated.
@@ -234,129 +654,255 @@ class MyServiceFramework(win32serviceutil.ServiceFramework):
         return job_handle
 
     def load_programs(self, config):
-        """Loads program definitions from the configuration."""
+        """Loads program definitions from the configuration.
+
+        A program with an invalid definition is logged and left out, so it does not keep the others from starting.
+        """
         programs = {}
-        for section in config.sections():
-            if section.startswith("program:"):
-                program_name = section.split(":", 1)[1]
-                programs[program_name] = Program(program_name, config[section], self.job_handle)
+        for program_name, options in program_sections(config).items():
+            try:
+                programs[program_name] = Program(program_name, options, self.job_handle)
+            except ValueError as e:  # noqa: PERF203 `try`-`except` within a loop incurs performance overhead. Each program may fail on its own.
+                servicemanager.LogErrorMsg(f"Invalid program {program_name}: {e!s}")
         return programs
 
     def start_xmlrpc_server(self):
         """Starts the XML-RPC server in a separate thread."""
-        self.xmlrpc_server = xmlrpc.server.SimpleXMLRPCServer(("127.0.0.1", 9001), allow_none=True)
+        self.xmlrpc_server = ThreadingXMLRPCServer(
+            (XMLRPC_HOST, XMLRPC_PORT),
+            requestHandler=QuietXMLRPCRequestHandler,
+            logRequests=False,
+            allow_none=True,
+        )
         self.xmlrpc_server.register_instance(self)
         self.xmlrpc_thread = threading.Thread(target=self.xmlrpc_server.serve_forever)
         self.xmlrpc_thread.start()
 
     def start_autostart_programs(self):
         """Starts all programs marked as autostart."""
-        for program in self.programs.values():
-            if program.autostart:
-                program.start_program()
+        self._run_parallel(operator.methodcaller("start_program"), [program for program in self.programs.values() if program.autostart])
+
+    def _run_parallel(self, action, programs):
+        """Calls `action(program)` for each program on the thread pool and waits until all are done."""
+        list(self._pool.map(action, programs))
 
     def is_running(self):
         return self.running
 
     def monitor_programs(self):
-        """Monitors the running programs and restarts if necessary."""
+        """Monitors the running programs and restarts if necessary.
+
+        Blocks on the process handles of the running programs, so the loop only wakes up when a program exits,
+        a program is started over XML-RPC or the service is stopped.
+        """
         while self.is_running():
-            time.sleep(1)
-            for program in self.programs.values():
-                if program.process is not None and program.process.poll() is not None and not program.is_starting:
-                    program.close_files()
-                    if program.autorestart:
-                        backoff = program.backoff_periods[min(program.backoff_index, len(program.backoff_periods) - 1)]
-                        time.sleep(backoff)
-                        program.restart_count += 1
-                        program.backoff_index = min(program.backoff_index + 1, len(program.backoff_periods) - 1)
+            next_restart = self._restart_due_programs()
+            starting = self._update_wait_handles()
+            # Programs still starting up are not watched yet, look again once their start-up check is done.
+            timeout = 1000 if starting else win32event.INFINITE
+            if next_restart is not None:
+                timeout = min(timeout, math.ceil(next_restart * 1000))
+            result = self._wait(timeout)
+            index = result - win32event.WAIT_OBJECT_0 - 2
+            if result != win32event.WAIT_TIMEOUT and 0 <= index < len(self._watched_programs):
+                self._handle_exit(self._watched_programs[index])
+            # Exits of processes beyond the first wait's capacity only show up as a wakeup, find them
+            for program in self._watched_programs[win32event.MAXIMUM_WAIT_OBJECTS - 2 :]:
+                if program.poll() is not None:
+                    self._handle_exit(program)
+        for waiter in self._overflow_waiters:
+            waiter.set_handles(None)
+        self._overflow_waiters = []
+        for handle in self._wait_objects[2:]:
+            handle.Close()
+        self._wait_objects = self._wait_objects[:2]
+        self._watched_pids = []
+        self._watched_programs = []
+
+    def _restart_due_programs(self):
+        """Restarts the programs whose backoff period is over.
+
+        Returns the seconds until the next pending restart, or None if there is none.
+        """
+        now = time.monotonic()
+        next_restart = None
+        for program in self.programs.values():
+            restart_time = program.next_restart_time
+            if restart_time is None:
+                continue
+            remaining = restart_time - now
+            if remaining <= 0:
+                with program.lock:
+                    # An XML-RPC stop or start may have cancelled the restart since it was read above
+                    restart_time = program.next_restart_time
+                    if restart_time is not None and restart_time <= now:
                         program.start_program()
+            elif next_restart is None or remaining < next_restart:
+                next_restart = remaining
+        return next_restart
+
+    def _wait(self, timeout):
+        """Waits on the first MAXIMUM_WAIT_OBJECTS entries of `_wait_objects` and returns the WaitForMultipleObjects result.
+
+        The remaining process handles are watched by `_overflow_waiters`, which set the wakeup event when one of their
+        processes exits.
+        """
+        return win32event.WaitForMultipleObjects(self._wait_objects[: win32event.MAXIMUM_WAIT_OBJECTS], False, timeout)  # noqa: FBT003 Boolean positional value in function call
+
+    def _update_overflow_waiters(self):
+        """Hands the process handles beyond the first wait's capacity to the waiters, in groups of one wait each.
+
+        Waiters are kept across calls and only told about groups that changed, the thread of a waiter that is no
+        longer needed exits.
+        """
+        limit = win32event.MAXIMUM_WAIT_OBJECTS
+        # Each waiter also waits on its refresh event, leaving limit - 1 handles per group
+        groups = [self._wait_objects[start : start + limit - 1] for start in range(limit, len(self._wait_objects), limit - 1)]
+        for waiter, group in zip(self._overflow_waiters, groups, strict=False):
+            if waiter.signalled or waiter.handles != group:
+                waiter.set_handles(group)
+        for waiter in self._overflow_waiters[len(groups) :]:
+            waiter.set_handles(None)
+        del self._overflow_waiters[len(groups) :]
+        for group in groups[len(self._overflow_waiters) :]:
+            self._overflow_waiters.append(HandleGroupWaiter(self._wakeup_event, group))
+
+    def _update_wait_handles(self):
+        """Opens a wait handle for each newly started process and closes the ones of stopped or replaced processes.
+
+        Returns whether any program is still starting up.
+        """
+        watched = {}
+        starting = False
+        for program in self.programs.values():
+            if program.is_starting:
+                starting = True
+            elif program.process is not None and program.next_restart_time is None:
+                watched[program.process.pid] = program
+        closed = []
+        for i in reversed(range(len(self._watched_pids))):
+            if self._watched_pids[i] not in watched:
+                closed.append(self._wait_objects.pop(i + 2))
+                del self._watched_pids[i]
+                del self._watched_programs[i]
+        known = set(self._watched_pids)
+        for pid, program in watched.items():
+            if pid in known:
+                continue
+            try:
+                handle = win32api.OpenProcess(win32con.SYNCHRONIZE | win32con.PROCESS_QUERY_INFORMATION, False, pid)  # noqa: FBT003 Boolean positional value in function call
+            except win32api.error as e:
+                servicemanager.LogErrorMsg(f"Failed to watch {program.name}: {e!s}")
+                continue
+            self._wait_objects.append(handle)
+            self._watched_pids.append(pid)
+            self._watched_programs.append(program)
+        self._update_overflow_waiters()
+        for handle in closed:  # Only now no waiter uses them any more
+            handle.Close()
+        return starting
+
+    def _handle_exit(self, program):
+        """Cleans up after an exited program and schedules its restart with backoff if configured.
+
+        The monitor loop keeps waiting meanwhile, so other programs and SvcStop are not held up by the backoff.
+        """
+        with program.lock:
+            if program.process is None or program.poll() is None:
+                return  # Stopped or restarted meanwhile
+            program.close_files()
+            if program.autorestart:
+                if (time.monotonic_ns() - program.start_time) / 1e9 > program.backoff_reset_uptime:
+                    program.backoff_index = 0  # It ran long enough to count as a successful start
+                backoff = program.backoff_periods[min(program.backoff_index, program.max_backoff_index)]
+                program.restart_count += 1
+                program.backoff_index = min(program.backoff_index + 1, program.max_backoff_index)
+                program.next_restart_time = time.monotonic() + backoff
+                program.state = STATE_BACKOFF
+            else:
+                program.process = None
+                program.state = STATE_STOPPED
 
     def SvcStop(self):  # noqa: N802 (Function name should be lowercase): overriding interface method.
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
         self.running = False
-        for program in self.programs.values():
-            program.stop_program()
+        win32event.SetEvent(self._stop_event)
+        # Close the XML-RPC server first, so no client can start a program again while they are being stopped
         self.xmlrpc_server.shutdown()
         self.xmlrpc_thread.join()
+        self.xmlrpc_server.server_close()
+        self._run_parallel(operator.methodcaller("stop_program"), self.programs.values())
+        self._pool.shutdown()
         self.ReportServiceStatus(win32service.SERVICE_STOPPED)
 
     # XML-RPC methods
     def status(self):
+        """Reports the state cached on each program, without querying the processes."""
+        now = time.monotonic_ns()
         status_list = []
-        for program in self.programs.values():
-            if program.is_starting:
-                state = "STARTING"
-                uptime = 0
-            elif program.process is not None and program.process.poll() is None:
-                state = "RUNNING"
-                uptime = time.time() - program.start_time
-            else:
-                state = "STOPPED"
-                uptime = 0
+        for program in list(self.programs.values()):
+            state = program.state
             status_list.append(
                 {
                     "name": program.name,
                     "state": state,
-                    "uptime": uptime,
+                    "uptime": (now - program.start_time) / 1e9 if state == STATE_RUNNING else 0,
                     "restart_count": program.restart_count,
                 },
             )
         return status_list
 
+    def reread(self):
+        """Reads the config file again and reports which programs were added, changed or removed since the service started.
+
+        Like supervisord's reread, this does not touch the running programs. An unchanged file is not parsed again,
+        load_config() serves it from the cache.
+        """
+        old = program_sections(self.config)
+        new = program_sections(self.load_config(self.config_path))
+        return {
+            "added": sorted(new.keys() - old.keys()),
+            "changed": sorted(name for name in new.keys() & old.keys() if new[name] != old[name]),
+            "removed": sorted(old.keys() - new.keys()),
+        }
+
     def start(self, program_name):
-        if program_name == "all":
-            for program in self.programs.values():
-                program.start_program()
-        else:
-            program = self.programs.get(program_name)
-            if program:
-                program.start_program()
-            else:
-                return f"Program '{program_name}' not found"
-        return "OK"
+        return self._apply(program_name, "start_program", wakeup=True)
 
     def stop(self, program_name):
-        if program_name == "all":
-            for program in self.programs.values():
-                program.stop_program()
-        else:
-            program = self.programs.get(program_name)
-            if program:
-                program.stop_program()
-            else:
-                return f"Program '{program_name}' not found"
-        return "OK"
+        return self._apply(program_name, "stop_program")
 
     def restart(self, program_name):
+        return self._apply(program_name, "restart_program", wakeup=True)
+
+    def _apply(self, program_name, method_name, *, wakeup=False):
+        """Calls `method_name` on the named program, or on all programs in parallel for "all".
+
+        With `wakeup`, the monitor is woken up afterwards to watch the started processes.
+        """
+        action = operator.methodcaller(method_name)
         if program_name == "all":
-            for program in self.programs.values():
-                program.stop_program()
-                program.start_program()
+            self._run_parallel(action, self.programs.values())
         else:
             program = self.programs.get(program_name)
-            if program:
-                program.stop_program()
-                program.start_program()
-            else:
+            if program is None:
                 return f"Program '{program_name}' not found"
+            action(program)
+        if wakeup:
+            win32event.SetEvent(self._wakeup_event)
         return "OK"
 
 
 def filter_args(args, keys_to_remove):
-    filtered_args = []
-    i = 0
-    while i < len(args):
-        if args[i] in keys_to_remove:
-            # Skip key and value only if the next arg is a value (not a flag or command)
+    # Positions of the keys and of their values
+    skip = set()
+    for i, arg in enumerate(args):
+        if arg in keys_to_remove:
+            skip.add(i)
+            # Skip the value only if the next arg is a value (not a flag or command)
             if i + 1 < len(args) and not args[i + 1].startswith("--"):
-                i += 2
-            else:
-                i += 1
-        else:
-            filtered_args.append(args[i])
-            i += 1
-    return filtered_args
+                skip.add(i + 1)
+    return [arg for i, arg in enumerate(args) if i not in skip]
 
 
 def main():
@@ -433,8 +979,7 @@ def handle_service_command(args, parser):
     argv_without_service = sys.argv[:i] + sys.argv[i + 2 :]
 
     # Remove --config and --env from remaining arguments
-    options_to_remove = ["--config", "--env"]
-    remaining_args = filter_args(argv_without_service[1:], options_to_remove)
+    remaining_args = filter_args(argv_without_service[1:], _SERVICE_OPTIONS)
 
     # Construct filtered_argv: script name, command, remaining arguments
     filtered_argv = [sys.argv[0], *remaining_args, command]
@@ -452,20 +997,27 @@ def validate_install_arguments(args, parser):
         parser.error(f"Config file '{args.config}' does not exist.")
 
 
+@functools.cache
+def get_server_proxy():
+    """Return the shared XML-RPC proxy of the service, so consecutive calls reuse one HTTP connection."""
+    transport = xmlrpc.client.Transport(use_builtin_types=True, headers=[("Connection", "keep-alive")])
+    return xmlrpc.client.ServerProxy(XMLRPC_URL, transport=transport, allow_none=True)
+
+
 def handle_program_command(args):
     """Handle program-related commands such as status, start, stop, and restart."""
 
     socket.setdefaulttimeout(10)
     try:
-        with xmlrpc.client.ServerProxy("http://127.0.0.1:9001") as server:
-            if args.command == "status":
-                print_status(server)
-            elif args.command == "start":
-                print_result(server.start(args.program), args.program, "Started")
-            elif args.command == "stop":
-                print_result(server.stop(args.program), args.program, "Stopped")
-            elif args.command == "restart":
-                print_result(server.restart(args.program), args.program, "Restarted")
+        server = get_server_proxy()
+        if args.command == "status":
+            print_status(server)
+        elif args.command == "start":
+            print_result(server.start(args.program), args.program, "Started")
+        elif args.command == "stop":
+            print_result(server.stop(args.program), args.program, "Stopped")
+        elif args.command == "restart":
+            print_result(server.restart(args.program), args.program, "Restarted")
     except (ConnectionRefusedError, TimeoutError):
         logging.exception("Service is not running. Please start the service first with 'python supervisor.py --service start'.")
 
@@ -506,7 +1058,11 @@ def print_status(server):
     rows = [[s["name"], str(s["state"]), format_uptime(s["uptime"]), str(s["restart_count"])] for s in status]
 
     # Compute column widths based on maximum content length
-    col_widths = [max(len(header), *(len(row[i]) for row in rows)) + 2 for i, header in enumerate(headers)]
+    col_widths = [len(header) for header in headers]
+    for row in rows:
+        for i, cell in enumerate(row):
+            col_widths[i] = max(col_widths[i], len(cell))
+    col_widths = [width + 2 for width in col_widths]
 
     # Print header row
     header_row = "".join(f"{header:<{width}}" for header, width in zip(headers, col_widths, strict=False))
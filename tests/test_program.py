@@ -1,9 +1,12 @@
 import configparser
+import gc
+import subprocess
+import threading
 import time
 import unittest
-from unittest.mock import Mock, call, mock_open, patch
+from unittest.mock import MagicMock, Mock, call, patch
 
-from pywin32supervisor.supervisor import Program
+from pywin32supervisor.supervisor import _MKDIR_CACHE, Program
 
 
 class TestProgram(unittest.TestCase):
@@ -19,6 +22,7 @@ class TestProgram(unittest.TestCase):
         }
         self.config = config["program:testprog"]
         self.job_handle = Mock()
+        _MKDIR_CACHE.clear()
 
     def test_program_init(self):
         program = Program("testprog", self.config, self.job_handle)
@@ -32,7 +36,7 @@ class TestProgram(unittest.TestCase):
 
     @patch("os.makedirs")
     @patch("subprocess.Popen")
-    @patch("builtins.open", new_callable=mock_open)
+    @patch("pywin32supervisor.supervisor.open_log_file")
     @patch("win32api.OpenProcess")
     @patch("win32job.AssignProcessToJobObject")
     def test_start_program_success(self, mock_assign, mock_open_process, mock_file, mock_popen, mock_makedirs):
@@ -49,12 +53,74 @@ class TestProgram(unittest.TestCase):
         mock_file.assert_called()
         self.assertIsNotNone(program.process)
         self.assertTrue(program.is_starting)
-        mock_open_process.assert_called_once_with(
-            257,
-            False,  # noqa: FBT003 Boolean positional value in function call. perms = PROCESS_TERMINATE | PROCESS_SET_QUOTA
-            123,
-        )
-        mock_assign.assert_called_once()
+        self.assertEqual(mock_popen.call_args.args[0], ["python", "-c", 'print("Hello")'])  # Quoted argument kept together
+        popen_kwargs = mock_popen.call_args.kwargs
+        self.assertIs(popen_kwargs["startupinfo"], program._startupinfo)  # noqa: SLF001 Private member accessed
+        self.assertEqual(popen_kwargs["creationflags"], subprocess.CREATE_NO_WINDOW | subprocess.CREATE_NEW_PROCESS_GROUP)
+        mock_open_process.assert_not_called()  # Popen's own process handle is reused
+        mock_assign.assert_called_once_with(self.job_handle, mock_process._handle)  # noqa: SLF001 Private member accessed
+
+    @patch("os.makedirs")
+    @patch("subprocess.Popen")
+    @patch("pywin32supervisor.supervisor.open_log_file")
+    @patch("win32api.OpenProcess")
+    @patch("win32job.AssignProcessToJobObject")
+    def test_start_program_creates_log_dirs_once(self, mock_assign, mock_open_process, mock_file, mock_popen, mock_makedirs):
+        mock_popen.return_value = Mock(poll=Mock(return_value=1), pid=123)
+        program = Program("testprog", self.config, self.job_handle)
+        program.start_program()
+        program.start_program()  # Restart after the process exited
+        Program("other", self.config, self.job_handle).start_program()  # Same log directory
+        self.assertEqual(mock_popen.call_count, 3)
+        mock_makedirs.assert_called_once_with("C:\\logs", exist_ok=True)  # stdout and stderr share it, first start only
+
+    @patch("os.makedirs")
+    @patch("subprocess.Popen")
+    @patch("pywin32supervisor.supervisor.open_log_file")
+    @patch("win32job.AssignProcessToJobObject")
+    def test_start_program_recreates_removed_log_dir(self, mock_assign, mock_file, mock_popen, mock_makedirs):
+        _MKDIR_CACHE.add("C:\\logs")  # Created by an earlier start, removed since
+        mock_file.side_effect = [FileNotFoundError, MagicMock(), MagicMock()]
+        program = Program("testprog", self.config, self.job_handle)
+        program.start_program()
+        mock_makedirs.assert_called_once_with("C:\\logs", exist_ok=True)
+        self.assertEqual([c.args[0] for c in mock_file.call_args_list], ["C:\\logs\\stdout.log", "C:\\logs\\stdout.log", "C:\\logs\\stderr.log"])
+        mock_popen.assert_called_once()
+
+    @patch("pywin32supervisor.supervisor.split_command", return_value=["cmd"])
+    def test_command_split_once(self, mock_split):
+        program = Program("testprog", self.config, self.job_handle)
+        program.process = Mock(poll=Mock(return_value=1))
+        with (
+            patch("subprocess.Popen") as mock_popen,
+            patch("win32job.AssignProcessToJobObject"),
+            patch("os.makedirs"),
+            patch("pywin32supervisor.supervisor.open_log_file"),
+        ):
+            program.start_program()
+            program.start_program()
+        mock_split.assert_called_once_with(self.config["command"])
+        self.assertEqual([c.args[0] for c in mock_popen.call_args_list], [["cmd"], ["cmd"]])
+
+    @patch("os.makedirs")
+    @patch("pywin32supervisor.supervisor.open_log_file")
+    @patch("win32job.AssignProcessToJobObject")
+    @patch("pywin32supervisor.supervisor._startup_timer")
+    def test_concurrent_starts_start_one_process(self, mock_timer, mock_assign, mock_file, mock_makedirs):
+        program = Program("testprog", self.config, self.job_handle)
+
+        def popen(*_, **__):
+            time.sleep(0.05)  # Give the other start call time to run into the lock
+            return Mock(poll=Mock(return_value=None), pid=123)
+
+        with patch("subprocess.Popen", side_effect=popen) as mock_popen:
+            threads = [threading.Thread(target=program.start_program) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        mock_popen.assert_called_once()
+        mock_file.return_value.__exit__.assert_not_called()  # The log files of the started process stay open
 
     def test_start_program_already_running(self):
         program = Program("testprog", self.config, self.job_handle)
@@ -72,6 +138,9 @@ class TestProgram(unittest.TestCase):
         program.process = process
         stdout_file = program.stdout_file = Mock(spec=["close"])
         stderr_file = program.stderr_file = Mock(spec=["close"])
+        program._files_stack.callback(stdout_file.close)  # noqa: SLF001 Private member accessed
+        program._files_stack.callback(stderr_file.close)  # noqa: SLF001 Private member accessed
+        program.next_restart_time = 1.0  # Pending autorestart
 
         # Mock the psutil.Process behavior
         mock_parent = Mock()
@@ -91,6 +160,15 @@ class TestProgram(unittest.TestCase):
         self.assertIsNone(program.stdout_file)
         self.assertIsNone(program.stderr_file)
         self.assertIsNone(program.process)
+        self.assertIsNone(program.next_restart_time)
+
+    def test_dropped_program_closes_files(self):
+        program = Program("testprog", self.config, self.job_handle)
+        stdout_file = Mock(spec=["close"])
+        program._files_stack.callback(stdout_file.close)  # noqa: SLF001 Private member accessed
+        del program
+        gc.collect()
+        stdout_file.close.assert_called_once()
 
     @patch("time.sleep")
     def test_autorestart_backoff(self, mock_sleep):
@@ -104,15 +182,31 @@ class TestProgram(unittest.TestCase):
 
         self.assertEqual(program.backoff_index, 0)  # Should reset after successful start
 
+    def test_poll_caches_exit_code(self):
+        program = Program("testprog", self.config, self.job_handle)
+        self.assertIsNone(program.poll())  # No process
+        program.process = Mock(poll=Mock(return_value=None))
+        self.assertIsNone(program.poll())
+        program.process.poll.return_value = 3
+        self.assertEqual(program.poll(), 3)
+        self.assertEqual(program.poll(), 3)
+        self.assertEqual(program.process.poll.call_count, 2)  # Not asked again once exited
+
+    def test_program_init_invalid_boolean(self):
+        self.config["autostart"] = "ture"
+        with self.assertRaises(ValueError):
+            Program("testprog", self.config, self.job_handle)
+
     def test_program_init_job_handle_and_backoff(self):
         job_handle = Mock()
         program = Program("testprog", self.config, job_handle)
         self.assertEqual(program.job_handle, job_handle)
         self.assertEqual(program.backoff_periods, [0, 1, 2, 5, 10, 15])
+        self.assertEqual(program.max_backoff_index, 5)
 
     @patch("os.makedirs")
     @patch("subprocess.Popen", side_effect=OSError("Test error"))
-    @patch("builtins.open", new_callable=mock_open)
+    @patch("pywin32supervisor.supervisor.open_log_file")
     def test_start_program_oserror(self, mock_file, mock_popen, mock_makedirs):
         program = Program("testprog", self.config, self.job_handle)
         with patch("servicemanager.LogErrorMsg") as mock_log:
@@ -120,10 +214,12 @@ class TestProgram(unittest.TestCase):
             mock_log.assert_called_once_with("Failed to start testprog: Test error")
         self.assertIsNone(program.process)
         self.assertFalse(program.is_starting)
+        mock_file.return_value.__exit__.assert_called()  # Log files are closed again
+        self.assertIsNone(program.stdout_file)
 
     @patch("os.makedirs")
     @patch("subprocess.Popen", side_effect=ValueError("Invalid command"))
-    @patch("builtins.open", new_callable=mock_open)
+    @patch("pywin32supervisor.supervisor.open_log_file")
     def test_start_program_valueerror(self, mock_file, mock_popen, mock_makedirs):
         program = Program("testprog", self.config, self.job_handle)
         with patch("servicemanager.LogErrorMsg") as mock_log:
@@ -134,13 +230,13 @@ class TestProgram(unittest.TestCase):
 
     @patch("os.makedirs")
     @patch("subprocess.Popen")
-    @patch("builtins.open", new_callable=mock_open)
+    @patch("pywin32supervisor.supervisor.open_log_file")
     @patch("win32api.OpenProcess")
     @patch("win32job.AssignProcessToJobObject")
-    @patch("time.sleep")
-    def test_check_start_success_reset_backoff(
+    @patch("pywin32supervisor.supervisor._startup_timer")
+    def test_check_start_success_keeps_backoff(
         self,
-        mock_sleep,
+        mock_timer,
         mock_assign,
         mock_open_process,
         mock_file,
@@ -156,9 +252,34 @@ class TestProgram(unittest.TestCase):
         program = Program("testprog", self.config, self.job_handle)
         program.backoff_index = 3  # Set a non-zero value
         program.start_program()
-        time.sleep(1.1)  # Simulate thread execution
-        self.assertEqual(program.backoff_index, 0)  # Should reset
+        mock_timer.schedule.assert_called_once()
+        delay, check = mock_timer.schedule.call_args.args
+        self.assertEqual(delay, 1)
+        self.assertEqual(check.args, (mock_process,))
+        check()  # Simulate the timer firing
+        self.assertEqual(program.backoff_index, 3)  # Only the monitor resets it, after backoff_reset_uptime
         self.assertFalse(program.is_starting)
+        self.assertEqual(program.state, "RUNNING")
+        with patch("pywin32supervisor.supervisor.kill_process_tree"):
+            program.stop_program()
+        self.assertEqual(program.state, "STOPPED")
+
+    @patch("os.makedirs")
+    @patch("subprocess.Popen")
+    @patch("pywin32supervisor.supervisor.open_log_file")
+    @patch("win32job.AssignProcessToJobObject")
+    @patch("pywin32supervisor.supervisor._startup_timer")
+    def test_stale_start_check_is_ignored(self, mock_timer, mock_assign, mock_file, mock_popen, mock_makedirs):
+        first, second = Mock(poll=Mock(return_value=1)), Mock(poll=Mock(return_value=None))
+        mock_popen.side_effect = [first, second]
+        program = Program("testprog", self.config, self.job_handle)
+        program.start_program()
+        stale_check = mock_timer.schedule.call_args.args[1]
+        with patch("pywin32supervisor.supervisor.kill_process_tree"):
+            program.restart_program()
+        stale_check()  # The check of the first process fires after the restart
+        self.assertIs(program.process, second)
+        self.assertEqual(program.state, "STARTING")  # Left to the check of the second process
 
 
 if __name__ == "__main__":
@@ -1,8 +1,10 @@
-import configparser
+import time
 import unittest
-from unittest.mock import MagicMock, Mock, patch
+from unittest.mock import MagicMock, Mock, mock_open, patch
 
-from pywin32supervisor.supervisor import MyServiceFramework, Program
+import win32event
+
+from pywin32supervisor.supervisor import _CONFIG_CACHE, MyServiceFramework, Program, QuietXMLRPCRequestHandler
 
 
 class TestServiceFramework(unittest.TestCase):
@@ -10,6 +12,7 @@ class TestServiceFramework(unittest.TestCase):
         with patch("win32serviceutil.ServiceFramework.__init__", return_value=None):
             self.service = MyServiceFramework()
         self.service.ReportServiceStatus = Mock()
+        _CONFIG_CACHE.clear()
 
     @patch("sys.argv", ["script.py", "service", "--config", "C:\\test\\supervisord.conf", "--env", "KEY=VALUE"])
     def test_parse_arguments(self):
@@ -17,32 +20,97 @@ class TestServiceFramework(unittest.TestCase):
         self.assertEqual(args.config, "C:\\test\\supervisord.conf")
         self.assertEqual(args.env, [("KEY", "VALUE")])
 
-    @patch("os.path.exists", return_value=True)
-    @patch("os.environ", {"KEY": "VALUE"})
-    def test_load_config_success(self, mock_exists):
-        # Create a pre-configured config object
-        config = configparser.RawConfigParser()
-        config.read_string("[program:test]\ncommand=python test.py")
-
-        # Patch RawConfigParser to return our config object when instantiated
-        with patch("configparser.RawConfigParser") as mock_config_parser:
-            mock_instance = mock_config_parser.return_value
-            mock_instance.read.return_value = None  # Simulate reading the file
-            mock_instance.sections.return_value = config.sections()
-            for section in config.sections():
-                mock_instance.__getitem__.return_value = config[section]
+    @patch("os.stat", return_value=Mock(st_mtime_ns=1, st_size=1))
+    @patch.dict("os.environ", {"KEY": "VALUE"})
+    def test_load_config_success(self, mock_stat):
+        with patch("builtins.open", mock_open(read_data="[program:test]\ncommand=python test.py\n")):
+            loaded_config = self.service.load_config("C:\\test\\supervisord.conf")
+
+        self.assertIn("program:test", loaded_config)
+        self.assertEqual(loaded_config["program:test"]["command"], "python test.py")
+
+    @patch("os.stat", return_value=Mock(st_mtime_ns=1, st_size=1))
+    def test_load_config_comments_and_continuations(self, mock_stat):
+        data = "; comment\n[program:test]\n# comment\nCommand = python\n  test.py\n\nautostart: true\n"
+        with patch("builtins.open", mock_open(read_data=data)):
+            loaded_config = self.service.load_config("C:\\test\\supervisord.conf")
+
+        self.assertEqual(loaded_config, {"program:test": {"command": "python\ntest.py", "autostart": "true"}})
+
+    @patch("os.stat", return_value=Mock(st_mtime_ns=1, st_size=1))
+    def test_load_config_invalid_line(self, mock_stat):
+        with patch("builtins.open", mock_open(read_data="command=python test.py\n")), self.assertRaises(ValueError):
+            self.service.load_config("C:\\test\\supervisord.conf")
+
+    @patch("os.stat", return_value=Mock(st_mtime_ns=1, st_size=1))
+    def test_load_config_default_section(self, mock_stat):
+        data = "[DEFAULT]\nautostart=true\nautorestart=true\n[program:test]\ncommand=cmd\nautorestart=false\n"
+        with patch("builtins.open", mock_open(read_data=data)):
+            loaded_config = self.service.load_config("C:\\test\\supervisord.conf")
+
+        self.assertEqual(loaded_config, {"program:test": {"autostart": "true", "autorestart": "false", "command": "cmd"}})
+
+    @patch("os.stat", return_value=Mock(st_mtime_ns=1, st_size=1))
+    def test_load_config_duplicates(self, mock_stat):
+        for data in ("[program:test]\ncommand=a\nCommand=b\n", "[program:test]\ncommand=a\n[program:test]\nautostart=true\n"):
+            with patch("builtins.open", mock_open(read_data=data)), self.assertRaises(ValueError):
+                self.service.load_config("C:\\test\\supervisord.conf")
+
+    @patch("os.stat", return_value=Mock(st_mtime_ns=1, st_size=1))
+    def test_load_config_header_with_comment(self, mock_stat):
+        with patch("builtins.open", mock_open(read_data="[program:a] ; comment\ncommand=cmd\n")):
+            loaded_config = self.service.load_config("C:\\test\\supervisord.conf")
+
+        self.assertEqual(loaded_config, {"program:a": {"command": "cmd"}})
+
+    @patch("os.stat", return_value=Mock(st_mtime_ns=1, st_size=1))
+    def test_load_config_blank_lines_in_value(self, mock_stat):
+        with patch("builtins.open", mock_open(read_data="[program:test]\ncommand=x\n\n  y\n\nautostart=true\n")):
+            loaded_config = self.service.load_config("C:\\test\\supervisord.conf")
+
+        self.assertEqual(loaded_config, {"program:test": {"command": "x\n\ny", "autostart": "true"}})
 
+    @patch("os.stat", return_value=Mock(st_mtime_ns=1, st_size=1))
+    def test_load_config_header_before_option(self, mock_stat):
+        with patch("builtins.open", mock_open(read_data="[x]=1\ncommand=cmd\n")):
             loaded_config = self.service.load_config("C:\\test\\supervisord.conf")
 
-            # Verify the loaded config
-            self.assertIn("program:test", loaded_config.sections())
-            self.assertEqual(loaded_config["program:test"]["command"], "python test.py")
+        self.assertEqual(loaded_config, {"x": {"command": "cmd"}})
 
-    @patch("os.path.exists", return_value=False)
+    @patch("os.stat", return_value=Mock(st_mtime_ns=1, st_size=1))
+    def test_load_config_cached(self, mock_stat):
+        with patch("builtins.open", mock_open(read_data="[program:test]\ncommand=cmd\n")) as mock_file:
+            first = self.service.load_config("C:\\test\\supervisord.conf")
+            first["program:test"]["command"] = "changed"
+            second = self.service.load_config("C:\\test\\supervisord.conf")
+            mock_file.assert_called_once()
+        self.assertEqual(second["program:test"]["command"], "cmd")
+
+        mock_stat.return_value = Mock(st_mtime_ns=2, st_size=1)
+        with patch("builtins.open", mock_open(read_data="[program:test]\ncommand=new\n")):
+            third = self.service.load_config("C:\\test\\supervisord.conf")
+        self.assertEqual(third["program:test"]["command"], "new")
+        self.assertEqual(len(_CONFIG_CACHE), 1)  # The entry of the old contents was replaced
+
+    def test_reread(self):
+        self.service.config_path = "C:\\test\\supervisord.conf"
+        self.service.config = {
+            "program:same": {"command": "a"},
+            "program:edited": {"command": "b"},
+            "program:dropped": {"command": "c"},
+            "unrelated": {"key": "value"},
+        }
+        new_config = {"program:same": {"command": "a"}, "program:edited": {"command": "b2"}, "program:new": {"command": "d"}}
+        self.service.load_config = Mock(return_value=new_config)
+        self.assertEqual(self.service.reread(), {"added": ["new"], "changed": ["edited"], "removed": ["dropped"]})
+        self.service.load_config.assert_called_once_with("C:\\test\\supervisord.conf")
+
+    @patch("os.stat", side_effect=FileNotFoundError)
     @patch("servicemanager.LogErrorMsg")
-    def test_load_config_file_not_found(self, mock_log, mock_exists):
+    def test_load_config_file_not_found(self, mock_log, mock_stat):
         with self.assertRaises(FileNotFoundError):
             self.service.load_config("nonexistent.conf")
+        mock_log.assert_called_once_with("Config file not found: nonexistent.conf")
 
     def test_start_autostart_programs(self):
         self.service.programs = {
@@ -59,18 +127,47 @@ class TestServiceFramework(unittest.TestCase):
         args = self.service.parse_arguments()
         self.assertEqual(args.config, "C:\\test\\supervisord.conf")
 
-    @patch("os.path.exists", return_value=True)
-    @patch("os.environ", {"ENV_TEST": "value"})
-    def test_load_config_with_env_substitution(self, mock_exists):
-        config = configparser.RawConfigParser()
-        config.read_string("[program:test]\ncommand=%(ENV_TEST)s test.py")
-        with patch("configparser.RawConfigParser") as mock_config_parser:
-            mock_instance = mock_config_parser.return_value
-            mock_instance.read.return_value = None
-            mock_instance.sections.return_value = config.sections()
-            mock_instance.__getitem__.side_effect = lambda s: config[s]
+    @patch("sys.argv", ["script.py", "service", "--env", "A=1", "--config=C:\\test\\supervisord.conf", "--env=B=2=3"])
+    def test_parse_arguments_inline_values(self):
+        args = self.service.parse_arguments()
+        self.assertEqual(args.config, "C:\\test\\supervisord.conf")
+        self.assertEqual(args.env, [("A", "1"), ("B", "2=3")])
+
+    @patch("sys.argv", ["script.py", "service", "--config", "C:\\test\\supervisord.conf"])
+    def test_parse_arguments_without_env(self):
+        self.assertIsNone(self.service.parse_arguments().env)
+
+    @patch("servicemanager.LogErrorMsg")
+    def test_parse_arguments_env_without_equals(self, mock_log):
+        for value in ("KEY", "=VALUE"):
+            with (
+                patch("sys.argv", ["script.py", "service", "--config", "x.conf", "--env", value]),
+                self.assertRaisesRegex(ValueError, "expected NAME=VALUE"),
+            ):
+                self.service.parse_arguments()
+        mock_log.assert_called_with("Argument --env: expected NAME=VALUE, got '=VALUE'")
+
+    @patch("servicemanager.LogErrorMsg")
+    def test_parse_arguments_errors(self, mock_log):
+        for argv in (["--env", "A=1"], ["--config"], ["--config", "x.conf", "--unknown"]):
+            with patch("sys.argv", ["script.py", "service", *argv]), self.assertRaises(ValueError):
+                self.service.parse_arguments()
+
+    @patch("os.stat", return_value=Mock(st_mtime_ns=1, st_size=1))
+    @patch.dict("os.environ", {"ENV_TEST": "value"})
+    def test_load_config_with_env_substitution(self, mock_stat):
+        with patch("builtins.open", mock_open(read_data="[program:test]\ncommand=%(ENV_TEST)s test.py\n")):
+            loaded_config = self.service.load_config("C:\\test\\supervisord.conf")
+        self.assertEqual(loaded_config["program:test"]["command"], "value test.py")
+
+    @patch("os.stat", return_value=Mock(st_mtime_ns=1, st_size=1))
+    def test_load_config_with_unset_env(self, mock_stat):
+        with (
+            patch.dict("os.environ", {}, clear=True),
+            patch("builtins.open", mock_open(read_data="[program:test]\ncommand=%(ENV_MISSING)s test.py\n")),
+        ):
             loaded_config = self.service.load_config("C:\\test\\supervisord.conf")
-            self.assertEqual(loaded_config["program:test"]["command"], "value test.py")
+        self.assertEqual(loaded_config["program:test"]["command"], " test.py")
 
     @patch("win32job.CreateJobObject")
     @patch("win32job.QueryInformationJobObject")
@@ -89,23 +186,22 @@ class TestServiceFramework(unittest.TestCase):
         mock_assign.assert_called_once()
         self.assertEqual(job_handle, mock_job)
 
-    @patch("os.path.exists", return_value=True)
-    def test_load_programs(self, mock_exists):
-        config = configparser.RawConfigParser()
-        config.read_string("[program:test]\ncommand=cmd")
-        with patch("configparser.RawConfigParser") as mock_config_parser:
-            mock_instance = mock_config_parser.return_value
-            mock_instance.read.return_value = None
-            mock_instance.sections.return_value = config.sections()
-            mock_instance.__getitem__.side_effect = lambda s: config[s]
-            self.service.config_path = "C:\\test\\supervisord.conf"
-            self.service.job_handle = Mock()
-            self.service.load_config = lambda _: config
-            programs = self.service.load_programs(config)
-            self.assertIn("test", programs)
-            self.assertIsInstance(programs["test"], Program)
-
-    @patch("xmlrpc.server.SimpleXMLRPCServer")
+    def test_load_programs(self):
+        config = {"program:test": {"command": "cmd"}, "unrelated": {"key": "value"}}
+        self.service.job_handle = Mock()
+        programs = self.service.load_programs(config)
+        self.assertEqual(list(programs), ["test"])
+        self.assertIsInstance(programs["test"], Program)
+
+    @patch("servicemanager.LogErrorMsg")
+    def test_load_programs_skips_invalid_program(self, mock_log):
+        config = {"program:bad": {"command": 'echo "hi'}, "program:good": {"command": "cmd"}}
+        self.service.job_handle = Mock()
+        programs = self.service.load_programs(config)
+        self.assertEqual(list(programs), ["good"])
+        mock_log.assert_called_once_with("Invalid program bad: No closing quotation")
+
+    @patch("pywin32supervisor.supervisor.ThreadingXMLRPCServer")
     @patch("threading.Thread")
     def test_start_xmlrpc_server(self, mock_thread, mock_server):
         mock_server_instance = Mock()
@@ -114,30 +210,160 @@ class TestServiceFramework(unittest.TestCase):
         mock_thread.return_value = mock_thread_instance
 
         self.service.start_xmlrpc_server()
-        mock_server.assert_called_once_with(("127.0.0.1", 9001), allow_none=True)
+        mock_server.assert_called_once_with(
+            ("127.0.0.1", 9001),
+            requestHandler=QuietXMLRPCRequestHandler,
+            logRequests=False,
+            allow_none=True,
+        )
         mock_server_instance.register_instance.assert_called_once_with(self.service)
         mock_thread.assert_called_once_with(target=mock_server_instance.serve_forever)
         mock_thread_instance.start.assert_called_once()
 
-    @patch("time.sleep")
-    def test_monitor_programs_autorestart(self, mock_sleep):
-        self.service.is_running = MagicMock(side_effect=[True, False])
+    @patch("win32api.OpenProcess")
+    @patch("win32event.WaitForMultipleObjects", side_effect=[2, 1])
+    def test_monitor_programs_autorestart(self, mock_wait, mock_open_process):
+        self.service.is_running = MagicMock(side_effect=[True, True, False])
         mock_program = Mock(
-            process=Mock(poll=Mock(return_value=1)),  # Process ended
+            process=Mock(pid=123),
+            poll=Mock(return_value=1),  # Process ended
             autorestart=True,
             is_starting=False,
             close_files=Mock(),
             start_program=Mock(),
             backoff_index=0,
             backoff_periods=[0, 1, 2],
+            max_backoff_index=2,
             restart_count=0,
+            next_restart_time=None,
+            start_time=time.monotonic_ns(),
+            backoff_reset_uptime=10,
+            lock=MagicMock(),
         )
         self.service.programs = {"test": mock_program}
         self.service.monitor_programs()
+        mock_open_process.assert_called_once()
+        self.assertEqual(mock_open_process.call_args.args[2], 123)
         mock_program.close_files.assert_called_once()
-        mock_program.start_program.assert_called_once()
+        mock_program.start_program.assert_called_once()  # On the next pass, the first backoff period is 0
         self.assertEqual(mock_program.restart_count, 1)
         self.assertEqual(mock_program.backoff_index, 1)
+        self.assertEqual(mock_program.state, "BACKOFF")
+        mock_open_process.return_value.Close.assert_called_once()
+
+    def test_handle_exit_backoff_grows_for_crash_loop(self):
+        program = Program("test", {"command": "cmd", "autorestart": "true"})
+        now = time.monotonic_ns()
+        with patch("time.monotonic_ns", return_value=now):
+            for expected_index in (1, 2, 3):
+                program.process = Mock(poll=Mock(return_value=1))
+                program._exit_cached = None  # noqa: SLF001 Private member accessed
+                program.start_time = now - 2_500_000_000  # Crashed 2.5 s after starting, past the 1 s start-up check
+                self.service._handle_exit(program)  # noqa: SLF001 Private member accessed
+                self.assertEqual(program.backoff_index, expected_index)
+            self.assertAlmostEqual(program.next_restart_time - time.monotonic(), 2, delta=0.5)  # Third period, no reset happened
+
+            program.process = Mock(poll=Mock(return_value=1))
+            program._exit_cached = None  # noqa: SLF001 Private member accessed
+            program.start_time = now - 11_000_000_000  # Ran longer than backoff_reset_uptime
+            self.service._handle_exit(program)  # noqa: SLF001 Private member accessed
+        self.assertEqual(program.backoff_index, 1)  # Started over from the first period
+
+    def test_restart_due_programs_skips_restart_cancelled_meanwhile(self):
+        mock_program = Mock(next_restart_time=time.monotonic() - 1, start_program=Mock(), lock=MagicMock())
+
+        def stop_first(*_args):
+            mock_program.next_restart_time = None  # An XML-RPC stop got the lock before the monitor
+
+        mock_program.lock.__enter__.side_effect = stop_first
+        self.service.programs = {"test": mock_program}
+        self.assertIsNone(self.service._restart_due_programs())  # noqa: SLF001 Private member accessed
+        mock_program.lock.__enter__.assert_called_once()
+        mock_program.start_program.assert_not_called()
+
+    @patch("win32event.WaitForMultipleObjects", return_value=win32event.WAIT_TIMEOUT)
+    def test_monitor_programs_waits_for_backoff(self, mock_wait):
+        self.service.is_running = MagicMock(side_effect=[True, False])
+        mock_program = Mock(process=Mock(pid=123), is_starting=False, start_program=Mock())
+        mock_program.next_restart_time = time.monotonic() + 5
+        self.service.programs = {"test": mock_program}
+        self.service.monitor_programs()
+        mock_program.start_program.assert_not_called()
+        self.assertEqual(len(mock_wait.call_args.args[0]), 2)  # Handle of the exited process is not waited on
+        self.assertGreater(mock_wait.call_args.args[2], 4000)
+        self.assertLessEqual(mock_wait.call_args.args[2], 5000)
+
+    @patch("win32api.OpenProcess")
+    @patch("win32event.WaitForMultipleObjects", return_value=2)
+    def test_monitor_programs_exit_without_autorestart(self, mock_wait, mock_open_process):
+        self.service.is_running = MagicMock(side_effect=[True, False])
+        mock_program = Mock(
+            process=Mock(pid=123),
+            poll=Mock(return_value=1),
+            autorestart=False,
+            is_starting=False,
+            close_files=Mock(),
+            start_program=Mock(),
+            next_restart_time=None,
+            lock=MagicMock(),
+        )
+        self.service.programs = {"test": mock_program}
+        self.service.monitor_programs()
+        mock_program.close_files.assert_called_once()
+        mock_program.start_program.assert_not_called()
+        self.assertIsNone(mock_program.process)
+        self.assertEqual(mock_program.state, "STOPPED")
+
+    @patch("win32api.OpenProcess")
+    def test_monitor_programs_closes_handle_of_stopped_program(self, mock_open_process):
+        self.service.is_running = MagicMock(side_effect=[True, True, False])
+        mock_program = Mock(process=Mock(pid=123), is_starting=False, next_restart_time=None)
+        self.service.programs = {"test": mock_program}
+        wait_sizes = []
+
+        def wait(objects, *_):
+            wait_sizes.append(len(objects))
+            mock_program.process = None  # Stopped over XML-RPC while waiting
+            return 1  # Wakeup event
+
+        with patch("win32event.WaitForMultipleObjects", side_effect=wait):
+            self.service.monitor_programs()
+        self.assertEqual(wait_sizes, [3, 2])
+        mock_open_process.return_value.Close.assert_called_once()
+
+    @patch("win32event.MAXIMUM_WAIT_OBJECTS", 4)
+    @patch("win32api.OpenProcess", side_effect=lambda *args: Mock(pid=args[2]))
+    @patch("pywin32supervisor.supervisor.HandleGroupWaiter")
+    def test_monitor_programs_more_handles_than_one_wait(self, mock_waiter_class, mock_open_process):
+        self.service.is_running = MagicMock(side_effect=[True, True, False])
+        programs = [Mock(process=Mock(pid=pid), poll=Mock(return_value=None), is_starting=False, next_restart_time=None) for pid in (1, 2, 3)]
+        programs[2].poll.return_value = 1  # Only fits the waiter's wait
+        self.service.programs = {str(i): program for i, program in enumerate(programs)}
+        self.service._handle_exit = Mock()  # noqa: SLF001 Private member accessed
+        mock_waiter = mock_waiter_class.return_value
+        mock_waiter.signalled = False
+
+        def create_waiter(_, handles):
+            mock_waiter.handles = handles
+            return mock_waiter
+
+        mock_waiter_class.side_effect = create_waiter
+
+        with patch("win32event.WaitForMultipleObjects", return_value=1) as mock_wait:  # Woken up by the waiter
+            self.service.monitor_programs()
+        mock_waiter_class.assert_called_once()  # Kept across both passes
+        self.assertEqual([handle.pid for handle in mock_waiter_class.call_args.args[1]], [3])
+        self.assertEqual([len(c.args[0]) for c in mock_wait.call_args_list], [4, 4])  # Two events and two handles
+        mock_waiter.set_handles.assert_called_once_with(None)  # Its unchanged group is not handed over again
+        self.service._handle_exit.assert_called_with(programs[2])  # noqa: SLF001 Private member accessed
+
+    @patch("win32event.WaitForMultipleObjects", return_value=0)
+    def test_monitor_programs_skips_starting(self, mock_wait):
+        self.service.is_running = MagicMock(side_effect=[True, False])
+        self.service.programs = {"test": Mock(process=Mock(pid=123), is_starting=True, next_restart_time=None)}
+        self.service.monitor_programs()
+        self.assertEqual(len(mock_wait.call_args.args[0]), 2)  # Only the stop and wakeup events
+        self.assertEqual(mock_wait.call_args.args[2], 1000)
 
     def test_svc_stop(self):
         self.service.running = True
@@ -145,11 +371,14 @@ class TestServiceFramework(unittest.TestCase):
         self.service.xmlrpc_thread = Mock()
         self.service.programs = {"test": Mock(stop_program=Mock())}
 
-        self.service.SvcStop()
+        with patch("win32event.SetEvent") as mock_set_event:
+            self.service.SvcStop()
+            mock_set_event.assert_called_once_with(self.service._stop_event)  # noqa: SLF001 Private member accessed
         self.assertFalse(self.service.running)
         self.service.programs["test"].stop_program.assert_called_once()
         self.service.xmlrpc_server.shutdown.assert_called_once()
         self.service.xmlrpc_thread.join.assert_called_once()
+        self.service.xmlrpc_server.server_close.assert_called_once()
 
 
 if __name__ == "__main__":
@@ -1,17 +1,27 @@
 import argparse
+import os
+import threading
 import unittest
 from unittest.mock import Mock, patch
 
+import ntsecuritycon
+import win32file
+
 from pywin32supervisor.supervisor import (
+    HandleGroupWaiter,
+    StartupTimer,
     create_argument_parser,
     filter_args,
     format_uptime,
+    get_server_proxy,
     handle_program_command,
     handle_service_command,
     is_service_mode,
     main,
+    open_log_file,
     print_result,
     print_status,
+    split_command,
     validate_install_arguments,
 )
 
@@ -30,6 +40,33 @@ class TestUtils(unittest.TestCase):
         filtered = filter_args(args, {"--service", "--config"})
         self.assertEqual(filtered, ["extra"])
 
+    def test_filter_args_key_without_value(self):
+        args = ["--env", "A=1", "--env", "B=2", "--config", "--wait", "5"]
+        filtered = filter_args(args, {"--env", "--config"})
+        self.assertEqual(filtered, ["--wait", "5"])
+
+    def test_split_command(self):
+        self.assertEqual(split_command("python -c 'print(\"Hello\")'"), ["python", "-c", 'print("Hello")'])
+        self.assertEqual(split_command('"C:\\Program Files\\app.exe" --name "a b"'), ["C:\\Program Files\\app.exe", "--name", "a b"])
+
+    @patch("builtins.open")
+    @patch("msvcrt.open_osfhandle", return_value=3)
+    @patch("win32file.CreateFile")
+    def test_open_log_file_append_only(self, mock_create, mock_open_osfhandle, mock_open):
+        log_file = open_log_file("C:\\logs\\out.log")
+        self.assertEqual(mock_create.call_args.args[:2], ("C:\\logs\\out.log", ntsecuritycon.FILE_APPEND_DATA))
+        mock_open_osfhandle.assert_called_once_with(mock_create.return_value.Detach.return_value, os.O_WRONLY | os.O_APPEND)
+        mock_open.assert_called_once_with(3, "ab", buffering=0)
+        self.assertIs(log_file, mock_open.return_value)
+
+    def test_open_log_file_error(self):
+        error = win32file.error(5, "CreateFile", "Access is denied.")
+        with patch("win32file.CreateFile", side_effect=error), self.assertRaises(OSError) as cm:
+            open_log_file("C:\\logs\\out.log")
+        self.assertIsInstance(cm.exception, PermissionError)
+        self.assertEqual(cm.exception.winerror, 5)
+        self.assertEqual(cm.exception.filename, "C:\\logs\\out.log")
+
     def test_format_uptime(self):
         self.assertEqual(format_uptime(0), "N/A")
         self.assertEqual(format_uptime(3665), "1h 1m 5s")
@@ -82,6 +119,7 @@ class TestUtils(unittest.TestCase):
 
     @patch("xmlrpc.client.ServerProxy", side_effect=ConnectionRefusedError)
     def test_handle_program_command_connection_error(self, mock_proxy):
+        get_server_proxy.cache_clear()
         args = argparse.Namespace(command="status", program="all")
         with patch("logging.exception") as mock_log:
             handle_program_command(args)
@@ -89,6 +127,14 @@ class TestUtils(unittest.TestCase):
                 "Service is not running. Please start the service first with 'python supervisor.py --service start'.",
             )
 
+    @patch("xmlrpc.client.ServerProxy")
+    def test_get_server_proxy_is_shared(self, mock_proxy):
+        get_server_proxy.cache_clear()
+        self.assertIs(get_server_proxy(), get_server_proxy())
+        mock_proxy.assert_called_once()
+        self.assertEqual(mock_proxy.call_args.args, ("http://127.0.0.1:9001",))
+        get_server_proxy.cache_clear()
+
     def test_format_uptime_full_range(self):
         self.assertEqual(format_uptime(0), "N/A")
         self.assertEqual(format_uptime(65), "1m 5s")
@@ -102,11 +148,67 @@ class TestUtils(unittest.TestCase):
         print_status(server)
         mock_log.assert_called()
 
+    @patch("logging.info")
+    def test_print_status_column_widths(self, mock_log):
+        server = Mock()
+        server.status.return_value = [
+            {"name": "a", "state": "RUNNING", "uptime": 65, "restart_count": 1},
+            {"name": "longername", "state": "STOPPED", "uptime": 0, "restart_count": 12},
+        ]
+        print_status(server)
+        lines = [c.args[0] for c in mock_log.call_args_list]
+        self.assertEqual(lines[0], "Name        State    Uptime  Restarts  ")
+        self.assertEqual(lines[1], "-" * 39)
+        self.assertEqual(lines[3], "longername  STOPPED  N/A     12        ")
+
     @patch("logging.info")
     def test_print_result(self, mock_log):
         print_result("OK", "testprog", "Started")
         mock_log.assert_called_once_with("%s program '%s': %s", "Started", "testprog", "OK")
 
+    def test_startup_timer_runs_callbacks_in_deadline_order(self):
+        timer = StartupTimer()
+        calls = []
+        done = threading.Event()
+        timer.schedule(0.05, lambda: (calls.append("late"), done.set()))
+        timer.schedule(0, lambda: calls.append("early"))
+        self.assertTrue(done.wait(5))
+        self.assertEqual(calls, ["early", "late"])
+
+    def test_handle_group_waiter(self):
+        refresh_event, wakeup_event, exited, running = Mock(), Mock(), Mock(), Mock()
+        refreshed, woken_up = threading.Event(), threading.Event()
+        waits = []
+
+        def set_event(event):
+            (refreshed if event is refresh_event else woken_up).set()
+
+        def wait_refresh(*_):
+            refreshed.wait()
+            refreshed.clear()  # Auto-reset
+            return 0
+
+        def wait(objects, *_):
+            waits.append(objects)
+            return 1 if exited in objects else wait_refresh()
+
+        with (
+            patch("win32event.CreateEvent", return_value=refresh_event),
+            patch("win32event.SetEvent", side_effect=set_event),
+            patch("win32event.WaitForMultipleObjects", side_effect=wait),
+            patch("win32event.WaitForSingleObject", side_effect=wait_refresh),
+        ):
+            waiter = HandleGroupWaiter(wakeup_event, [exited])
+            self.assertTrue(woken_up.wait(5))
+            self.assertTrue(waiter.signalled)
+            waiter.set_handles([running])  # Returns once the thread no longer waits on `exited`
+            self.assertFalse(waiter.signalled)
+            waiter.set_handles(None)
+            waiter._thread.join(5)  # noqa: SLF001 Private member accessed
+        self.assertFalse(waiter._thread.is_alive())  # noqa: SLF001 Private member accessed
+        self.assertEqual(waits, [[refresh_event, exited], [refresh_event, running]])
+        refresh_event.Close.assert_called_once()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,12 @@
 import configparser
+import http.client
+import threading
 import time
 import unittest
+import xmlrpc.client
 from unittest.mock import Mock, patch
 
-from pywin32supervisor.supervisor import MyServiceFramework, Program
+from pywin32supervisor.supervisor import MyServiceFramework, Program, QuietXMLRPCRequestHandler, ThreadingXMLRPCServer
 
 
 class TestXMLRPC(unittest.TestCase):
@@ -18,25 +21,30 @@ class TestXMLRPC(unittest.TestCase):
             "prog2": Program("prog2", config["program:prog2"], Mock()),
         }
         self.service.programs["prog1"].process = Mock(poll=lambda: None)
-        self.service.programs["prog1"].start_time = time.time() - 60
+        self.service.programs["prog1"].start_time = time.monotonic_ns() - 60 * 10**9
         self.service.programs["prog1"].restart_count = 2
-        self.service.programs["prog1"].is_starting = False
+        self.service.programs["prog1"].state = "RUNNING"
         self.service.programs["prog2"].process = None
         self.service.programs["prog2"].start_time = None
         self.service.programs["prog2"].restart_count = 0
-        self.service.programs["prog2"].is_starting = False
 
     def test_status(self):
         status = self.service.status()
         self.assertEqual(len(status), 2)
         self.assertEqual(status[0]["name"], "prog1")
         self.assertEqual(status[0]["state"], "RUNNING")
-        self.assertGreater(status[0]["uptime"], 0)
+        self.assertGreaterEqual(status[0]["uptime"], 60)
+        self.assertLess(status[0]["uptime"], 70)
         self.assertEqual(status[0]["restart_count"], 2)
         self.assertEqual(status[1]["name"], "prog2")
         self.assertEqual(status[1]["state"], "STOPPED")
         self.assertEqual(status[1]["uptime"], 0)
 
+    def test_status_does_not_poll(self):
+        self.service.programs["prog1"].process = Mock()
+        self.service.status()
+        self.service.programs["prog1"].process.poll.assert_not_called()
+
     def test_start_all(self):
         for prog in self.service.programs.values():
             prog.start_program = Mock()
@@ -46,12 +54,32 @@ class TestXMLRPC(unittest.TestCase):
             prog.start_program.assert_called_once()
         self.assertEqual(result, "OK")
 
+    def test_stop_all(self):
+        for prog in self.service.programs.values():
+            prog.stop_program = Mock()
+        result = self.service.stop("all")
+
+        for prog in self.service.programs.values():
+            prog.stop_program.assert_called_once()
+        self.assertEqual(result, "OK")
+
+    def test_restart_all(self):
+        for prog in self.service.programs.values():
+            prog.stop_program = Mock()
+            prog.start_program = Mock()
+        result = self.service.restart("all")
+
+        for prog in self.service.programs.values():
+            prog.stop_program.assert_called_once()
+            prog.start_program.assert_called_once()
+        self.assertEqual(result, "OK")
+
     def test_stop_program_not_found(self):
         result = self.service.stop("nonexistent")
         self.assertEqual(result, "Program 'nonexistent' not found")
 
     def test_status_starting_state(self):
-        self.service.programs["prog1"].is_starting = True
+        self.service.programs["prog1"].state = "STARTING"
         status = self.service.status()
         self.assertEqual(status[0]["state"], "STARTING")
         self.assertEqual(status[0]["uptime"], 0)
@@ -81,5 +109,55 @@ class TestXMLRPC(unittest.TestCase):
         self.assertEqual(result, "OK")
 
 
+class TwoWorkerXMLRPCServer(ThreadingXMLRPCServer):
+    max_workers = 2
+
+
+class TestThreadingXMLRPCServer(unittest.TestCase):
+    def setUp(self):
+        self.server = TwoWorkerXMLRPCServer(("127.0.0.1", 0), requestHandler=QuietXMLRPCRequestHandler, logRequests=False)
+        self.server.register_function(lambda: "pong", "ping")
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.connections = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        for connection in self.connections:
+            connection.close()
+
+    def call(self):
+        """Opens a connection and makes one ping call on it, returns the connection and the response."""
+        connection = http.client.HTTPConnection(*self.server.server_address, timeout=5)
+        self.connections.append(connection)
+        connection.request("POST", "/RPC2", xmlrpc.client.dumps((), "ping"), {"Content-Type": "text/xml"})
+        response = connection.getresponse()
+        self.assertEqual(xmlrpc.client.loads(response.read())[0], ("pong",))
+        return connection, response
+
+    def test_keeps_connection_alive(self):
+        connection, response = self.call()
+        self.assertIsNone(response.getheader("Connection"))
+        connection.request("POST", "/RPC2", xmlrpc.client.dumps((), "ping"), {"Content-Type": "text/xml"})
+        self.assertEqual(xmlrpc.client.loads(connection.getresponse().read())[0], ("pong",))
+
+    def test_closes_connections_when_saturated(self):
+        self.call()  # Kept alive, holds one of the two workers
+        _, response = self.call()
+        self.assertEqual(response.getheader("Connection"), "close")
+        self.call()  # A third client is still served
+
+    def test_server_close_shuts_down_open_connections(self):
+        connection, _ = self.call()
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(connection.sock.recv(1), b"")
+        for worker in threading.enumerate():
+            if worker.name == "xmlrpc":
+                self.assertTrue(worker.daemon)
+
+
 if __name__ == "__main__":
     unittest.main()